@@ -25,7 +25,6 @@ some systems. They may be OS- or architecture-dependent or custom-developed for
 particular customer.
 '''
 
-import pkg_resources
 import qubes.events
 
 
@@ -55,6 +54,8 @@ class Extension:
 
 
 def get_extensions():
+    # imported here, as importing pkg_resources is expensive
+    import pkg_resources
     return set(ext.load()()
         for ext in pkg_resources.iter_entry_points('qubes.ext'))
 
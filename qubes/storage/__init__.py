@@ -22,24 +22,46 @@
 
 """ Qubes storage system"""
 
+import ctypes
+import ctypes.util
 import functools
-import inspect
 import os
 import os.path
 import string
 import subprocess
-import time
-from datetime import datetime
+import threading
+import xml.sax.saxutils
+from datetime import datetime, timezone
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    # python < 3.8
+    from importlib_metadata import entry_points
 
 import asyncio
 import lxml.etree
-import pkg_resources
 import qubes
 import qubes.exc
 import qubes.utils
 
 STORAGE_ENTRY_POINT = 'qubes.storage'
 
+#: Pool driver classes already loaded by :py:func:`_load_driver`, indexed by
+#: driver name
+_driver_classes = {}
+
+#: libvirt XML of a disk attached by :py:meth:`Storage.attach`; all the
+#: values need to be already quoted with :py:func:`xml.sax.saxutils.quoteattr`
+_DISK_XML_TEMPLATE = (
+    '<disk type="block" device="disk">'
+    '<driver name="phy"/>'
+    '<source dev={dev}/>'
+    '<target dev={target}/>'
+    '{readonly}'
+    '{backenddomain}'
+    '</disk>')
+
 
 class StoragePoolException(qubes.exc.QubesException):
     ''' A general storage exception '''
@@ -48,6 +70,8 @@ class StoragePoolException(qubes.exc.QubesException):
 class BlockDevice:
     ''' Represents a storage block device. '''
     # pylint: disable=too-few-public-methods
+    __slots__ = ('path', 'name', 'rw', 'script', 'domain', 'devtype')
+
     def __init__(self, path, name, script=None, rw=True, domain=None,
                  devtype='disk'):
         assert name, 'Missing device name'
@@ -134,8 +158,13 @@ class Volume:
         self.source = source
         #: Volume unique (inside given pool) identifier
         self.vid = vid
-        #: Asynchronous lock for @Volume.locked decorator
-        self._lock = asyncio.Lock()
+        #: Asynchronous lock for @Volume.locked decorator, created on first
+        #: use as many drivers do not need it
+        self._lock = None
+        # pool name and vid do not change during volume lifetime, so compute
+        # the values derived from them only once
+        self._pool_str = str(pool)
+        self._hash = hash((self._pool_str, vid))
 
     def __eq__(self, other):
         if isinstance(other, Volume):
@@ -143,20 +172,20 @@ class Volume:
         return NotImplemented
 
     def __hash__(self):
-        return hash('%s:%s' % (self.pool, self.vid))
+        return self._hash
 
     def __neq__(self, other):
         return not self.__eq__(other)
 
     def __repr__(self):
-        return '{!r}'.format(str(self.pool) + ':' + self.vid)
+        return '{!r}'.format(self._pool_str + ':' + self.vid)
 
     def __str__(self):
         return str(self.vid)
 
     def __xml__(self):
         config = _sanitize_config(self.config)
-        return lxml.etree.Element('volume', **config)
+        return lxml.etree.Element('volume', attrib=config)
 
     @staticmethod
     def locked(method):
@@ -164,7 +193,10 @@ class Volume:
         '''
         @functools.wraps(method)
         async def wrapper(self, *args, **kwargs):
-            async with self._lock:  # pylint: disable=protected-access
+            # pylint: disable=protected-access
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
                 return await method(self, *args, **kwargs)
         return wrapper
 
@@ -345,7 +377,7 @@ class Volume:
         ''' return config data for serialization to qubes.xml '''
         result = {
             'name': self.name,
-            'pool': str(self.pool),
+            'pool': self._pool_str,
             'vid': self.vid,
             'revisions_to_keep': self.revisions_to_keep,
             'rw': self.rw,
@@ -374,7 +406,7 @@ class Storage:
     in mind.
     '''
 
-    AVAILABLE_FRONTENDS = {'xvd' + c for c in string.ascii_lowercase}
+    AVAILABLE_FRONTENDS = tuple('xvd' + c for c in string.ascii_lowercase)
 
     def __init__(self, vm):
         #: Domain for which we manage storage
@@ -382,6 +414,9 @@ class Storage:
         self.log = self.vm.log
         #: Additional drive (currently used only by HVM)
         self.drive = None
+        #: Last libvirt domain XML seen and its parsed tree, see
+        #: :py:meth:`_get_parsed_domain_xml`
+        self._domain_xml_cache = None, None
 
         if hasattr(vm, 'volume_config'):
             for name, conf in self.vm.volume_config.items():
@@ -431,6 +466,8 @@ class Storage:
         if 'internal' in volume_config:
             # migrate old config
             del volume_config['internal']
+        # pool drivers fill in the config they got (pool object, vid, ...),
+        # don't let that leak into vm.volume_config
         volume = pool.init_volume(self.vm, volume_config.copy())
         self.vm.volumes[name] = volume
         return volume
@@ -439,28 +476,15 @@ class Storage:
         ''' Attach a volume to the domain '''
         assert self.vm.is_running()
 
-        if self._is_already_attached(volume):
+        parsed_xml = self._get_parsed_domain_xml()
+        if self._is_already_attached(volume, parsed_xml):
             self.vm.log.info("{!r} already attached".format(volume))
             return
 
-        try:
-            frontend = self.unused_frontend()
-        except IndexError:
-            raise StoragePoolException("No unused frontend found")
-        disk = lxml.etree.Element("disk")
-        disk.set('type', 'block')
-        disk.set('device', 'disk')
-        lxml.etree.SubElement(disk, 'driver').set('name', 'phy')
-        lxml.etree.SubElement(disk, 'source').set('dev', '/dev/%s' % volume.vid)
-        lxml.etree.SubElement(disk, 'target').set('dev', frontend)
-        if not rw:
-            lxml.etree.SubElement(disk, 'readonly')
+        frontend = self._find_unused_frontend(
+            self._used_frontends(parsed_xml))
 
-        if volume.domain is not None:
-            lxml.etree.SubElement(disk, 'backenddomain').set(
-                'name', volume.domain.name)
-
-        xml_string = lxml.etree.tostring(disk, encoding='utf-8')
+        xml_string = self._disk_xml(volume, frontend, rw)
         self.vm.libvirt_domain.attachDevice(xml_string)
         # trigger watches to update device status
         # FIXME: this should be removed once libvirt will report such
@@ -468,22 +492,81 @@ class Storage:
         # self.vm.untrusted_qdb.write('/qubes-block-devices', '')
         # ← do we need this?
 
-    def _is_already_attached(self, volume):
-        ''' Checks if the given volume is already attached '''
-        parsed_xml = lxml.etree.fromstring(self.vm.libvirt_domain.XMLDesc())
-        disk_sources = parsed_xml.xpath("//domain/devices/disk/source")
-        for source in disk_sources:
-            if source.get('dev') == '/dev/%s' % volume.vid:
-                return True
-        return False
+    def attach_many(self, volumes, rw=False):
+        ''' Attach several volumes to the domain
+
+        This works like calling :py:meth:`attach` for each volume, but
+        the domain XML is retrieved from libvirt only once.
+        '''
+        assert self.vm.is_running()
+
+        parsed_xml = self._get_parsed_domain_xml()
+        used_frontends = self._used_frontends(parsed_xml)
+        attached = set()
+        disks_xml = []
+        for volume in volumes:
+            if volume in attached or \
+                    self._is_already_attached(volume, parsed_xml):
+                self.vm.log.info("{!r} already attached".format(volume))
+                continue
+            frontend = self._find_unused_frontend(used_frontends)
+            used_frontends.add(frontend)
+            attached.add(volume)
+            disks_xml.append(self._disk_xml(volume, frontend, rw))
+
+        # libvirt wrappers are not thread-safe (they may reconnect), so do not
+        # call them from executor threads
+        for disk_xml in disks_xml:
+            self.vm.libvirt_domain.attachDevice(disk_xml)
+
+    @staticmethod
+    def _disk_xml(volume, frontend, rw):
+        ''' Return libvirt XML (as bytes) for attaching *volume* as
+        *frontend* device '''
+        backenddomain = ''
+        if volume.domain is not None:
+            backenddomain = '<backenddomain name={}/>'.format(
+                xml.sax.saxutils.quoteattr(volume.domain.name))
+
+        return _DISK_XML_TEMPLATE.format(
+            dev=xml.sax.saxutils.quoteattr('/dev/%s' % volume.vid),
+            target=xml.sax.saxutils.quoteattr(frontend),
+            readonly='' if rw else '<readonly/>',
+            backenddomain=backenddomain).encode('utf-8')
+
+    def _get_parsed_domain_xml(self):
+        ''' Return parsed libvirt XML description of the domain.
+
+        The description is fetched from libvirt on every call, but parsed
+        again only if it changed since the last call. The returned tree
+        is shared between calls and must not be modified.
+        '''
+        domain_xml = self.vm.libvirt_domain.XMLDesc()
+        cached_xml, parsed_xml = self._domain_xml_cache
+        if domain_xml != cached_xml:
+            parsed_xml = lxml.etree.fromstring(domain_xml)
+            self._domain_xml_cache = domain_xml, parsed_xml
+        return parsed_xml
+
+    def _is_already_attached(self, volume, parsed_xml=None):
+        ''' Checks if the given volume is already attached
+
+        :param parsed_xml: parsed domain XML to look in, fetched from
+            libvirt if not given
+        '''
+        dev = '/dev/%s' % volume.vid
+        if parsed_xml is None:
+            parsed_xml = self._get_parsed_domain_xml()
+        return any(source.get('dev') == dev
+                   for source in parsed_xml.iterfind('devices/disk/source'))
 
     def detach(self, volume):
         ''' Detach a volume from domain '''
-        parsed_xml = lxml.etree.fromstring(self.vm.libvirt_domain.XMLDesc())
-        disks = parsed_xml.xpath("//domain/devices/disk")
-        for disk in disks:
-            source = disk.xpath('source')[0]
-            if source.get('dev') == '/dev/%s' % volume.vid:
+        dev = '/dev/%s' % volume.vid
+        parsed_xml = self._get_parsed_domain_xml()
+        for disk in parsed_xml.iterfind('devices/disk'):
+            source = disk.find('source')
+            if source is not None and source.get('dev') == dev:
                 disk_xml = lxml.etree.tostring(disk, encoding='utf-8')
                 self.vm.libvirt_domain.detachDevice(disk_xml)
                 return
@@ -507,10 +590,7 @@ class Storage:
 
     def get_disk_utilization(self):
         ''' Returns summed up disk utilization for all domain volumes '''
-        result = 0
-        for volume in self.vm.volumes.values():
-            result += volume.usage
-        return result
+        return sum(volume.usage for volume in self.vm.volumes.values())
 
     async def resize(self, volume, size):
         ''' Resizes volume a read-writable volume '''
@@ -549,18 +629,23 @@ class Storage:
         msg = "Importing volume {!s} from vm {!s}"
         self.vm.log.info(msg.format(src_volume.name, src_vm.name))
         await qubes.utils.coro_maybe(dst.create())
-        await qubes.utils.coro_maybe(dst.import_volume(src_volume))
+        # register the volume before importing data, so it gets cleaned up
+        # if this (or any other concurrently cloned) volume fails
         self.vm.volumes[name] = dst
-        return self.vm.volumes[name]
+        await qubes.utils.coro_maybe(dst.import_volume(src_volume))
+        return dst
 
     async def clone(self, src_vm):
-        ''' Clone volumes from the specified vm '''
+        ''' Clone volumes from the specified vm
+
+        All the volumes are cloned concurrently.
+        '''
 
         self.vm.volumes = {}
-        with VmCreationManager(self.vm):
+        async with VmCreationManager(self.vm):
             await qubes.utils.void_coros_maybe(
                 self.clone_volume(src_vm, vol_name)
-                for vol_name in self.vm.volume_config.keys())
+                for vol_name in self.vm.volume_config)
 
     @property
     def outdated_volumes(self):
@@ -618,19 +703,33 @@ class Storage:
             vol.stop() for vol in self.vm.volumes.values())
 
     def unused_frontend(self):
-        ''' Find an unused device name '''
-        unused_frontends = self.AVAILABLE_FRONTENDS.difference(
-            self.used_frontends)
-        return sorted(unused_frontends)[0]
+        ''' Find an unused device name
+
+        :raise StoragePoolException: if all the frontends are used
+        '''
+        return self._find_unused_frontend(self.used_frontends)
+
+    def _find_unused_frontend(self, used_frontends):
+        ''' Return the first of :py:attr:`AVAILABLE_FRONTENDS` not in
+        *used_frontends*
+
+        :raise StoragePoolException: if all the frontends are used
+        '''
+        for frontend in self.AVAILABLE_FRONTENDS:
+            if frontend not in used_frontends:
+                return frontend
+        raise StoragePoolException("No unused frontend found")
 
     @property
     def used_frontends(self):
         ''' Used device names '''
-        xml = self.vm.libvirt_domain.XMLDesc()
-        parsed_xml = lxml.etree.fromstring(xml)
+        return self._used_frontends(self._get_parsed_domain_xml())
+
+    @staticmethod
+    def _used_frontends(parsed_xml):
+        ''' Device names used in given parsed domain XML '''
         return {target.get('dev', None)
-                    for target in parsed_xml.xpath(
-                        "//domain/devices/disk/target")}
+                    for target in parsed_xml.iterfind('devices/disk/target')}
 
     async def export(self, volume):
         ''' Helper function to export volume (pool.export(volume))'''
@@ -719,10 +818,19 @@ class VolumesCollection:
         ''' Check if given volume (either Volume ID or Volume instance) is
         present in the pool
         '''
+        if isinstance(item, Volume):
+            if item.pool != self._pool:
+                return False
+            item = item.vid
         try:
-            return self[item] is not None
+            return self._pool.get_volume(item) is not None
         except KeyError:
             return False
+        except NotImplementedError:
+            pass
+        # if list_volumes is not implemented too, it will raise
+        # NotImplementedError
+        return any(vol.vid == item for vol in self)
 
     def keys(self):
         ''' Return list of volume IDs '''
@@ -766,7 +874,7 @@ class Pool:
 
     def __xml__(self):
         config = _sanitize_config(self.config)
-        return lxml.etree.Element('pool', **config)
+        return lxml.etree.Element('pool', attrib=config)
 
     @property
     def config(self):
@@ -852,124 +960,387 @@ class Pool:
 def _sanitize_config(config):
     ''' Helper function to convert types to appropriate strings
     '''  # FIXME: find another solution for serializing basic types
+    # False is dropped, True is serialized as 'True'
+    return {key: 'True' if value is True else str(value)
+        for key, value in config.items() if value is not False}
+
+
+def _storage_entry_points():
+    ''' Return entry points registered in the :py:data:`STORAGE_ENTRY_POINT`
+    group '''
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        # python >= 3.10 (or importlib_metadata >= 3.6)
+        return eps.select(group=STORAGE_ENTRY_POINT)
+    return eps.get(STORAGE_ENTRY_POINT, ())
+
+
+@functools.lru_cache(maxsize=None)
+def _all_driver_entry_points():
+    ''' Return a dict of lists of pool driver entry points, indexed by driver
+    name
+
+    The result is cached (even if empty), as installed drivers do not change
+    during process lifetime.
+    '''
     result = {}
-    for key, value in config.items():
-        if isinstance(value, bool):
-            if value:
-                result[key] = 'True'
-        else:
-            result[key] = str(value)
+    for entry_point in _storage_entry_points():
+        same_name = result.setdefault(entry_point.name, [])
+        # the same distribution may be found more than once on sys.path
+        if all(other.value != entry_point.value for other in same_name):
+            same_name.append(entry_point)
     return result
 
 
+@functools.lru_cache(maxsize=None)
+def _driver_entry_points():
+    ''' Return a dict of pool driver entry points, indexed by driver name
+
+    Names provided by more than one entry point are left out: pools are
+    instantiated with :py:func:`qubes.utils.get_entry_point_one` (in
+    :py:meth:`qubes.app.Qubes._get_pool` and the callback driver), which
+    refuses them, so such drivers must not be advertised.
+    '''
+    return {name: eps[0]
+        for name, eps in _all_driver_entry_points().items() if len(eps) == 1}
+
+
+def _get_driver(name):
+    ''' Return the entry point of a pool driver
+
+    :raise KeyError: if no such driver is installed
+    :raise TypeError: if more than one driver of that name is installed
+    '''
+    eps = _all_driver_entry_points()[name]
+    if len(eps) > 1:
+        raise TypeError(
+            'more than 1 implementation of {!r} found: {}'.format(name,
+                ', '.join(ep.value for ep in eps)))
+    return eps[0]
+
+
+def _load_driver(name):
+    ''' Return the class of a pool driver, importing its module if needed
+
+    :raise KeyError: if no such driver is installed
+    '''
+    cls = _driver_classes.get(name)
+    if cls is None:
+        cls = _driver_classes[name] = _get_driver(name).load()
+    return cls
+
+
 def pool_drivers():
     """ Return a list of EntryPoints names """
-    return [ep.name
-            for ep in pkg_resources.iter_entry_points(STORAGE_ENTRY_POINT)]
+    return list(_driver_entry_points())
+
 
+#: :py:meth:`Pool.__init__` parameters not reported by
+#: :py:func:`driver_parameters`
+_IGNORED_DRIVER_PARAMS = frozenset(('self', 'name', 'kwargs'))
 
+@functools.lru_cache(maxsize=None)
 def driver_parameters(name):
-    ''' Get __init__ parameters from a driver with out `self` & `name`. '''
-    init_function = qubes.utils.get_entry_point_one(
-        qubes.storage.STORAGE_ENTRY_POINT, name).__init__
-    signature = inspect.signature(init_function)
-    params = signature.parameters.keys()
-    ignored_params = ['self', 'name', 'kwargs']
-    return [p for p in params if p not in ignored_params]
+    ''' Get __init__ parameters from a driver with out `self` & `name`.
 
+    The result is cached, as installed drivers do not change during process
+    lifetime.
+    '''
+    init_function = _load_driver(name).__init__
+    # look through decorators, like inspect.signature() does
+    while hasattr(init_function, '__wrapped__'):
+        init_function = init_function.__wrapped__
+    code = init_function.__code__
+    # positional and keyword-only parameters (drivers use the latter), not
+    # *args nor **kwargs
+    params = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    return tuple(p for p in params if p not in _IGNORED_DRIVER_PARAMS)
+
+
+#: cached for :py:func:`isodate`
+_UTC = timezone.utc
 
 def isodate(seconds):
     ''' Helper method which returns an iso date '''
-    return datetime.utcfromtimestamp(seconds).isoformat("T")
+    # naive UTC datetime, like the deprecated datetime.utcfromtimestamp()
+    return datetime.fromtimestamp(seconds, _UTC).replace(
+        tzinfo=None).isoformat("T")
+
+def _is_under(child, parent):
+    ''' Check if canonical path *child* is *parent* or inside of it '''
+    return (child == parent or parent == os.sep
+        or child.startswith(parent + os.sep))
+
+def _pool_real_dir_path(pool):
+    ''' Canonical path of *pool.dir_path*
+
+    The result is remembered on the pool object, for as long as its
+    *dir_path* stays the same.
+    '''
+    # pylint: disable=protected-access
+    dir_path = pool.dir_path
+    cached = getattr(pool, '_cached_real_dir_path', None)
+    if cached is not None and cached[0] == dir_path:
+        return cached[1]
+    real_dir_path = os.path.realpath(dir_path)
+    pool._cached_real_dir_path = dir_path, real_dir_path
+    return real_dir_path
 
 def search_pool_containing_dir(pools, dir_path):
     ''' Helper function looking for a pool containing given directory.
 
     This is useful for implementing Pool.included_in method
+
+    Filesystem pools are checked first, in the order of *pools*, and the
+    first one containing the directory is returned - not necessarily the
+    innermost one, if pool directories are nested.
     '''
 
-    real_dir_path = os.path.realpath(dir_path)
+    # resolved only when needed
+    real_dir_path = None
+    lvm_pools = []
 
     # prefer filesystem pools
     for pool in pools:
-        if hasattr(pool, 'dir_path'):
-            pool_real_dir_path = os.path.realpath(pool.dir_path)
-            if os.path.commonpath([pool_real_dir_path, real_dir_path]) == \
-               pool_real_dir_path:
-                return pool
+        pool_dir_path = getattr(pool, 'dir_path', None)
+        if pool_dir_path is None:
+            # collect lvm pools in the same pass, for use below; no pool
+            # has both dir_path and thin_pool
+            if hasattr(pool, 'thin_pool') and hasattr(pool, 'volume_group'):
+                lvm_pools.append(pool)
+            continue
+        if pool_dir_path == dir_path:
+            # exactly the pool directory, obviously contained
+            return pool
+        if real_dir_path is None:
+            real_dir_path = os.path.realpath(dir_path)
+        pool_real_dir_path = _pool_real_dir_path(pool)
+        if _is_under(real_dir_path, pool_real_dir_path):
+            return pool
 
     # then look for lvm
-    for pool in pools:
-        if hasattr(pool, 'thin_pool') and hasattr(pool, 'volume_group'):
-            if (pool.volume_group, pool.thin_pool) == \
-                    DirectoryThinPool.thin_pool(real_dir_path):
-                return pool
+    if not lvm_pools:
+        return None
+    if real_dir_path is None:
+        real_dir_path = os.path.realpath(dir_path)
+    # the same for every pool, compute it only once
+    dir_thin_pool = DirectoryThinPool.thin_pool_real_path(real_dir_path)
+    if dir_thin_pool == (None, None):
+        return None
+    for pool in lvm_pools:
+        if (pool.volume_group, pool.thin_pool) == dir_thin_pool:
+            return pool
 
     return None
 
 
 class VmCreationManager:
-    ''' A `ContextManager` which cleans up if volume creation fails.
+    ''' An asynchronous `ContextManager` which cleans up if volume creation
+    fails.
+
+    The volumes are removed concurrently, errors on removal are ignored.
     '''  # pylint: disable=too-few-public-methods
     def __init__(self, vm):
         self.vm = vm
 
-    def __enter__(self):
+    async def __aenter__(self):
         pass
 
-    def __exit__(self, type, value, tb):  # pylint: disable=redefined-builtin
+    async def __aexit__(self, type, value, tb):
+        # pylint: disable=redefined-builtin
         if type is not None and value is not None and tb is not None:
+            coros = []
             for volume in self.vm.volumes.values():
                 try:
-                    volume.remove()
+                    result = volume.remove()
                 except Exception:  # pylint: disable=broad-except
-                    pass
+                    continue
+                if asyncio.iscoroutine(result):
+                    coros.append(result)
+            await asyncio.gather(*coros, return_exceptions=True)
             os.rmdir(self.vm.dir_path)
 
+#: ``DM_DEVICE_TABLE`` task type from ``libdevmapper.h``
+_DM_DEVICE_TABLE = 11
+#: ``dm_log_with_errno_fn`` from ``libdevmapper.h``, without the variadic
+#: arguments. Strictly, passing a non-variadic callback where C expects
+#: a variadic function type is undefined behaviour; it works only because
+#: common ABIs (x86-64 and aarch64 on Linux) pass the fixed arguments the
+#: same way in both cases, and the callback ignores the rest.
+_DM_LOG_FN = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_char_p,
+    ctypes.c_int, ctypes.c_int, ctypes.c_char_p)
+
+@functools.lru_cache(maxsize=None)
+def _libdevmapper():
+    ''' Load libdevmapper, or return None if it is not available '''
+    try:
+        lib = ctypes.CDLL('libdevmapper.so.1.02', use_errno=True)
+    except OSError:
+        # find_library() forks ldconfig (or even gcc), so only ask it when
+        # the soname is different (like libdevmapper.so.1.02.1 on Debian)
+        lib_name = ctypes.util.find_library('devmapper')
+        if lib_name is None:
+            return None
+        try:
+            lib = ctypes.CDLL(lib_name, use_errno=True)
+        except OSError:
+            return None
+    lib.dm_task_create.argtypes = [ctypes.c_int]
+    lib.dm_task_create.restype = ctypes.c_void_p
+    lib.dm_task_set_major.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.dm_task_set_major.restype = ctypes.c_int
+    lib.dm_task_set_minor.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    lib.dm_task_set_minor.restype = ctypes.c_int
+    lib.dm_task_run.argtypes = [ctypes.c_void_p]
+    lib.dm_task_run.restype = ctypes.c_int
+    lib.dm_get_next_target.argtypes = [ctypes.c_void_p, ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint64), ctypes.POINTER(ctypes.c_uint64),
+        ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_char_p)]
+    lib.dm_get_next_target.restype = ctypes.c_void_p
+    lib.dm_task_destroy.argtypes = [ctypes.c_void_p]
+    lib.dm_task_destroy.restype = None
+    # failures are handled by the caller, do not spam stderr like dmsetup
+    # would (its stderr was discarded too); keep a reference to the callback
+    # for as long as the library is loaded
+    lib.qubes_log_fn = _DM_LOG_FN(lambda *args: None)
+    lib.dm_log_with_errno_init.argtypes = [_DM_LOG_FN]
+    lib.dm_log_with_errno_init.restype = None
+    lib.dm_log_with_errno_init(lib.qubes_log_fn)
+    return lib
+
+def _dm_table(major, minor):
+    ''' Return device-mapper table of given device, as a list of
+    (start, length, target type, target args) tuples.
+
+    The table is read with libdevmapper directly when running as root,
+    otherwise (or if the library is missing) with :program:`dmsetup`.
+
+    :raises OSError: if the table cannot be read
+    :raises subprocess.CalledProcessError: if :program:`dmsetup` fails
+    '''
+    # only root can talk to device-mapper directly; do not even load the
+    # library otherwise, as that installs a process-wide logger
+    lib = None if os.getuid() else _libdevmapper()
+    if lib is None:
+        sudo = ['sudo'] if os.getuid() else []
+        table = subprocess.check_output(sudo + ['dmsetup',
+            '-j', str(major), '-m', str(minor),
+            'table'], stderr=subprocess.DEVNULL)
+        result = []
+        for line in table.decode().splitlines():
+            start, length, target_type, target_args = line.split(' ', 3)
+            result.append((int(start), int(length), target_type, target_args))
+        return result
+
+    task = lib.dm_task_create(_DM_DEVICE_TABLE)
+    if not task:
+        raise OSError(ctypes.get_errno(), 'dm_task_create failed')
+    try:
+        if not (lib.dm_task_set_major(task, major)
+                and lib.dm_task_set_minor(task, minor)
+                and lib.dm_task_run(task)):
+            raise OSError(ctypes.get_errno(),
+                'cannot read table of device {}:{}'.format(major, minor))
+        result = []
+        start = ctypes.c_uint64()
+        length = ctypes.c_uint64()
+        target_type = ctypes.c_char_p()
+        target_args = ctypes.c_char_p()
+        next_target = None
+        while True:
+            next_target = lib.dm_get_next_target(task, next_target,
+                ctypes.byref(start), ctypes.byref(length),
+                ctypes.byref(target_type), ctypes.byref(target_args))
+            if target_type.value is not None:
+                result.append((start.value, length.value,
+                    target_type.value.decode(),
+                    (target_args.value or b'').decode()))
+            if not next_target:
+                return result
+    finally:
+        lib.dm_task_destroy(task)
+
+def _split_lvm_dm_name(dm_name):
+    ''' Split device-mapper name of a LVM device into its components:
+    volume group, logical volume and optionally the layer (like "tpool").
+
+    LVM joins them with '-' and doubles any '-' inside of a name.
+    '''
+    parts = []
+    escaped = False
+    for piece in dm_name.split('-'):
+        if escaped:
+            parts[-1] += '-' + piece
+            escaped = False
+        elif not piece and parts:
+            # empty piece between '--': the previous name continues
+            escaped = True
+        else:
+            parts.append(piece)
+    return parts
+
+@functools.lru_cache(maxsize=128)
+def _thin_pool_for_realpath(real_dir_path):
+    '''Find out the thin pool containing given filesystem
+
+    Results are cached, except failures of the lookup itself, which are
+    raised instead.
+
+    :param real_dir_path: canonical path, as returned by
+        :py:func:`os.path.realpath`
+    :returns: tuple (volume group, pool name), or (None, None)
+    :raises OSError: if the lookup failed (missing directory, device-mapper
+        not accessible, ...)
+    :raises subprocess.CalledProcessError: if :program:`dmsetup` failed
+    '''
+    fs_stat = os.stat(real_dir_path)
+    fs_major = os.major(fs_stat.st_dev)
+    fs_minor = os.minor(fs_stat.st_dev)
+
+    # not a device-mapper device (or no block device at all, like
+    # tmpfs) - there is no table to look at
+    if not os.path.isdir('/sys/dev/block/{}:{}/dm'.format(
+            fs_major, fs_minor)):
+        return None, None
+
+    try:
+        _start, _sectors, target_type, target_args = \
+            _dm_table(fs_major, fs_minor)[0]
+        if target_type != "thin":
+            return None, None
+        thin_pool_devnum, _thin_pool_id = target_args.split(" ")
+    except (IndexError, ValueError):
+        # empty or unexpected table
+        return None, None
+    with open("/sys/dev/block/{}/dm/name"
+        .format(thin_pool_devnum), "r") as thin_pool_tpool_f:
+        thin_pool_tpool = thin_pool_tpool_f.read().rstrip('\n')
+    parts = _split_lvm_dm_name(thin_pool_tpool)
+    if len(parts) == 3 and parts[2] == "tpool":
+        # volume group, thin pool
+        return parts[0], parts[1]
+    return None, None
+
 # pylint: disable=too-few-public-methods
 class DirectoryThinPool:
     '''The thin pool containing the device of given filesystem'''
-    _thin_pool = {}
-
-    @classmethod
-    def _init(cls, dir_path):
-        '''Find out the thin pool containing given filesystem'''
-        if dir_path not in cls._thin_pool:
-            cls._thin_pool[dir_path] = None, None
-
-            try:
-                fs_stat = os.stat(dir_path)
-                fs_major = (fs_stat.st_dev & 0xff00) >> 8
-                fs_minor = fs_stat.st_dev & 0xff
-
-                sudo = []
-                if os.getuid():
-                    sudo = ['sudo']
-                root_table = subprocess.check_output(sudo + ["dmsetup",
-                    "-j", str(fs_major), "-m", str(fs_minor),
-                    "table"], stderr=subprocess.DEVNULL)
-
-                _start, _sectors, target_type, target_args = \
-                    root_table.decode().split(" ", 3)
-                if target_type == "thin":
-                    thin_pool_devnum, _thin_pool_id = target_args.split(" ")
-                    with open("/sys/dev/block/{}/dm/name"
-                        .format(thin_pool_devnum), "r") as thin_pool_tpool_f:
-                        thin_pool_tpool = thin_pool_tpool_f.read().rstrip('\n')
-                    if thin_pool_tpool.endswith("-tpool"):
-                        # LVM replaces '-' by '--' if name contains
-                        # a hyphen
-                        thin_pool_tpool = thin_pool_tpool.replace('--', '=')
-                        volume_group, thin_pool, _tpool = \
-                            thin_pool_tpool.rsplit("-", 2)
-                        volume_group = volume_group.replace('=', '-')
-                        thin_pool = thin_pool.replace('=', '-')
-                        cls._thin_pool[dir_path] = volume_group, thin_pool
-            except:  # pylint: disable=bare-except
-                pass
+    #: serializes lookups, so concurrent callers wait for a result being
+    #: computed instead of running the same lookup again
+    _lock = threading.Lock()
 
     @classmethod
     def thin_pool(cls, dir_path):
         '''Thin tuple (volume group, pool name) containing given filesystem'''
-        cls._init(dir_path)
-        return cls._thin_pool[dir_path]
+        # different spellings of the same directory share one cache entry
+        return cls.thin_pool_real_path(os.path.realpath(dir_path))
+
+    @classmethod
+    def thin_pool_real_path(cls, real_dir_path):
+        '''Like :py:meth:`thin_pool`, for a path already canonicalized with
+        :py:func:`os.path.realpath`'''
+        with cls._lock:
+            try:
+                return _thin_pool_for_realpath(real_dir_path)
+            except (OSError, subprocess.CalledProcessError):
+                # not cached, will be retried on the next call
+                return None, None
@@ -395,7 +395,7 @@ class ThinVolume(qubes.storage.Volume):
             assert hasattr(self, '_vid_snap')
             vid_to_commit = self._vid_snap
 
-        assert self._lock.locked()
+        assert self._lock is not None and self._lock.locked()
         if not os.path.exists('/dev/' + vid_to_commit):
             # nothing to commit
             return
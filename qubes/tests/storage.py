@@ -1,3 +1,5 @@
+# pylint: disable=protected-access
+
 #
 # The Qubes OS Project, https://www.qubes-os.org/
 #
@@ -16,8 +18,13 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
+import asyncio
+import functools
+import os
 import shutil
+import string
 import unittest.mock
+import lxml.etree
 import qubes.log
 import qubes.storage
 from qubes.exc import QubesException
@@ -194,3 +201,586 @@ class TC_00_Pool(QubesTestCase):
                          "Kernels pool should not report usage details.")
 
         self.loop.run_until_complete(self.app.remove_pool(pool_name))
+
+
+DOMAIN_XML = '''<domain type="xen">
+  <name>test-vm</name>
+  <devices>
+    <disk type="block" device="disk">
+      <driver name="phy"/>
+      <source dev="/dev/test-vg/root"/>
+      <target dev="xvda"/>
+    </disk>
+    <disk type="block" device="disk">
+      <driver name="phy"/>
+      <source dev="/dev/test-vg/private"/>
+      <target dev="xvdb"/>
+    </disk>
+  </devices>
+</domain>
+'''
+
+
+class TC_01_Storage(QubesTestCase):
+    """ This class tests libvirt related helpers of
+    :py:class:`qubes.storage.Storage` """
+
+    def setUp(self):
+        super().setUp()
+        self.vm = unittest.mock.Mock(
+            spec=['log', 'libvirt_domain', 'is_running', 'volumes'])
+        self.vm.libvirt_domain.XMLDesc.return_value = DOMAIN_XML
+        self.storage = qubes.storage.Storage(self.vm)
+        self.pool = qubes.storage.Pool(name='test-pool')
+
+    def test_000_used_frontends(self):
+        self.assertEqual(self.storage.used_frontends, {'xvda', 'xvdb'})
+
+    def test_001_is_already_attached(self):
+        volume = unittest.mock.Mock(vid='test-vg/private')
+        self.assertTrue(self.storage._is_already_attached(volume))
+        volume = unittest.mock.Mock(vid='test-vg/volatile')
+        self.assertFalse(self.storage._is_already_attached(volume))
+
+    def test_002_parsed_xml_cache(self):
+        parsed_xml = self.storage._get_parsed_domain_xml()
+        self.assertIs(self.storage._get_parsed_domain_xml(), parsed_xml)
+        self.vm.libvirt_domain.XMLDesc.return_value = \
+            DOMAIN_XML.replace('xvdb', 'xvdc')
+        self.assertIsNot(self.storage._get_parsed_domain_xml(), parsed_xml)
+        self.assertEqual(self.storage.used_frontends, {'xvda', 'xvdc'})
+
+    def test_003_start_concurrently(self):
+        started = []
+        all_started = asyncio.Event()
+
+        async def start(name):
+            started.append(name)
+            if len(started) == 2:
+                all_started.set()
+            await all_started.wait()
+
+        self.vm.volumes = {name: unittest.mock.Mock() for name in ('a', 'b')}
+        for name, volume in self.vm.volumes.items():
+            volume.start.side_effect = functools.partial(start, name)
+        self.loop.run_until_complete(
+            asyncio.wait_for(self.storage.start(), 1))
+        self.assertCountEqual(started, ['a', 'b'])
+
+    def test_004_start_error(self):
+        async def start(exc):
+            raise exc
+
+        self.vm.volumes = {name: unittest.mock.Mock() for name in ('a', 'b')}
+        self.vm.volumes['a'].start.side_effect = functools.partial(
+            start, qubes.storage.StoragePoolException('a'))
+        self.vm.volumes['b'].start.side_effect = functools.partial(
+            start, OSError('b'))
+        with self.assertRaisesRegex(qubes.storage.StoragePoolException, 'a'):
+            self.loop.run_until_complete(self.storage.start())
+
+    def test_005_attach(self):
+        self.vm.is_running.return_value = True
+        volume = unittest.mock.Mock(vid='test-vg/volatile', domain=None)
+        self.storage.attach(volume, rw=True)
+        self.vm.libvirt_domain.attachDevice.assert_called_once_with(
+            b'<disk type="block" device="disk"><driver name="phy"/>'
+            b'<source dev="/dev/test-vg/volatile"/><target dev="xvdc"/>'
+            b'</disk>')
+
+    def test_006_attach_readonly_backend(self):
+        self.vm.is_running.return_value = True
+        volume = unittest.mock.Mock(vid='test-vg/volatile')
+        volume.domain.name = 'sys-usb'
+        self.storage.attach(volume)
+        self.vm.libvirt_domain.attachDevice.assert_called_once_with(
+            b'<disk type="block" device="disk"><driver name="phy"/>'
+            b'<source dev="/dev/test-vg/volatile"/><target dev="xvdc"/>'
+            b'<readonly/><backenddomain name="sys-usb"/></disk>')
+
+    def test_007_attach_already_attached(self):
+        self.vm.is_running.return_value = True
+        volume = unittest.mock.Mock(vid='test-vg/private')
+        self.storage.attach(volume)
+        self.vm.libvirt_domain.attachDevice.assert_not_called()
+
+    def test_008_unused_frontend(self):
+        self.assertEqual(self.storage.unused_frontend(), 'xvdc')
+
+    def test_009_unused_frontend_all_used(self):
+        self.vm.libvirt_domain.XMLDesc.return_value = \
+            '<domain><devices>{}</devices></domain>'.format(''.join(
+                '<disk><target dev="xvd{}"/></disk>'.format(c)
+                for c in string.ascii_lowercase))
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.storage.unused_frontend()
+
+    def test_010_detach(self):
+        volume = unittest.mock.Mock(vid='test-vg/private')
+        self.storage.detach(volume)
+        self.vm.libvirt_domain.detachDevice.assert_called_once_with(
+            unittest.mock.ANY)
+        disk_xml = self.vm.libvirt_domain.detachDevice.call_args[0][0]
+        self.assertIn(b'<source dev="/dev/test-vg/private"/>', disk_xml)
+        self.assertIn(b'<target dev="xvdb"/>', disk_xml)
+
+    def test_011_detach_not_attached(self):
+        volume = unittest.mock.Mock(vid='test-vg/volatile')
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.storage.detach(volume)
+        self.vm.libvirt_domain.detachDevice.assert_not_called()
+
+    def test_012_attach_xmldesc_once(self):
+        self.vm.is_running.return_value = True
+        volume = unittest.mock.Mock(vid='test-vg/volatile', domain=None)
+        self.storage.attach(volume, rw=True)
+        self.vm.libvirt_domain.XMLDesc.assert_called_once_with()
+
+    def test_013_attach_many(self):
+        self.vm.is_running.return_value = True
+        volumes = [
+            qubes.storage.Volume('volatile', self.pool, 'test-vg/volatile'),
+            qubes.storage.Volume('private', self.pool, 'test-vg/private'),
+            qubes.storage.Volume('other', self.pool, 'test-vg/other'),
+            qubes.storage.Volume('other', self.pool, 'test-vg/other'),
+        ]
+        self.storage.attach_many(volumes)
+        self.vm.libvirt_domain.XMLDesc.assert_called_once_with()
+        self.assertEqual(
+            self.vm.libvirt_domain.attachDevice.mock_calls, [
+                unittest.mock.call(
+                    b'<disk type="block" device="disk"><driver name="phy"/>'
+                    b'<source dev="/dev/test-vg/volatile"/>'
+                    b'<target dev="xvdc"/><readonly/></disk>'),
+                unittest.mock.call(
+                    b'<disk type="block" device="disk"><driver name="phy"/>'
+                    b'<source dev="/dev/test-vg/other"/>'
+                    b'<target dev="xvdd"/><readonly/></disk>'),
+            ])
+
+    def test_014_creation_manager_cleanup(self):
+        removed = []
+        async def remove(name, fail=False):
+            removed.append(name)
+            if fail:
+                raise qubes.storage.StoragePoolException('remove failed')
+        root = unittest.mock.Mock()
+        root.remove.side_effect = functools.partial(remove, 'root', True)
+        private = unittest.mock.Mock()
+        private.remove.side_effect = functools.partial(remove, 'private')
+        kernel = unittest.mock.Mock()
+        kernel.remove.side_effect = OSError
+        self.vm.volumes = {'root': root, 'private': private, 'kernel': kernel}
+        self.vm.dir_path = '/var/lib/qubes/appvms/test-inst-vm'
+
+        async def create():
+            async with qubes.storage.VmCreationManager(self.vm):
+                raise QubesException('creation failed')
+        with unittest.mock.patch('os.rmdir') as mock_rmdir:
+            with self.assertRaises(QubesException):
+                self.loop.run_until_complete(create())
+        self.assertCountEqual(removed, ['root', 'private'])
+        mock_rmdir.assert_called_once_with(self.vm.dir_path)
+
+    def test_015_start_sync_error(self):
+        started = []
+
+        async def start():
+            started.append('a')
+
+        self.vm.volumes = {name: unittest.mock.Mock() for name in ('a', 'b')}
+        self.vm.volumes['a'].start.side_effect = start
+        self.vm.volumes['b'].start.side_effect = OSError('b')
+        with self.assertRaisesRegex(OSError, 'b'):
+            self.loop.run_until_complete(self.storage.start())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(started, [])
+
+
+class TC_02_Volume(QubesTestCase):
+    """ This class tests the base :py:class:`qubes.storage.Volume` """
+
+    def setUp(self):
+        super().setUp()
+        self.pool = qubes.storage.Pool(name='test-pool')
+
+    def test_000_hash(self):
+        volume = qubes.storage.Volume('root', self.pool, 'vm-root')
+        same = qubes.storage.Volume('private', self.pool, 'vm-root')
+        other = qubes.storage.Volume('root', self.pool, 'vm-private')
+        self.assertEqual(volume, same)
+        self.assertEqual(hash(volume), hash(same))
+        self.assertNotEqual(volume, other)
+        self.assertEqual(len({volume, same, other}), 2)
+
+    def test_001_repr(self):
+        volume = qubes.storage.Volume('root', self.pool, 'vm-root')
+        self.assertEqual(repr(volume), "'test-pool:vm-root'")
+        self.assertEqual(str(volume), 'vm-root')
+
+    def test_002_xml(self):
+        volume = qubes.storage.Volume('root', self.pool, 'vm-root',
+            rw=True, size=1024)
+        self.assertEqual(lxml.etree.tostring(volume.__xml__()),
+            b'<volume name="root" pool="test-pool" vid="vm-root" '
+            b'revisions_to_keep="0" rw="True" size="1024"/>')
+
+    def test_003_locked(self):
+        class TestVolume(qubes.storage.Volume):
+            @qubes.storage.Volume.locked
+            async def start(self):
+                assert self._lock.locked()
+                await asyncio.sleep(0)
+                return True
+
+        volume = TestVolume('root', self.pool, 'vm-root')
+        self.assertIsNone(volume._lock)
+        self.assertTrue(self.loop.run_until_complete(volume.start()))
+        self.assertFalse(volume._lock.locked())
+
+
+class TC_03_VolumesCollection(QubesTestCase):
+    """ This class tests :py:class:`qubes.storage.VolumesCollection` """
+
+    def setUp(self):
+        super().setUp()
+        self.pool = unittest.mock.Mock(spec=qubes.storage.Pool)
+        self.volumes = qubes.storage.VolumesCollection(self.pool)
+        self.volume = unittest.mock.Mock(spec=qubes.storage.Volume,
+            pool=self.pool, vid='vm-root')
+
+    def test_000_contains_get_volume(self):
+        self.pool.get_volume.side_effect = \
+            lambda vid: {'vm-root': self.volume}[vid]
+        self.assertIn('vm-root', self.volumes)
+        self.assertNotIn('vm-private', self.volumes)
+        self.pool.list_volumes.assert_not_called()
+
+    def test_001_contains_list_volumes(self):
+        self.pool.get_volume.side_effect = NotImplementedError
+        self.pool.list_volumes.return_value = [self.volume]
+        self.assertIn('vm-root', self.volumes)
+        self.assertNotIn('vm-private', self.volumes)
+
+    def test_002_contains_volume(self):
+        self.pool.get_volume.return_value = self.volume
+        self.assertIn(self.volume, self.volumes)
+        self.pool.get_volume.assert_called_once_with('vm-root')
+        other_volume = unittest.mock.Mock(spec=qubes.storage.Volume,
+            pool=unittest.mock.Mock(), vid='vm-root')
+        self.assertNotIn(other_volume, self.volumes)
+
+
+class TC_04_DirectoryThinPool(QubesTestCase):
+    """ This class tests :py:class:`qubes.storage.DirectoryThinPool` without
+    touching the system device-mapper configuration """
+
+    def setUp(self):
+        super().setUp()
+        # reset cache
+        qubes.storage._thin_pool_for_realpath.cache_clear()
+        self.addCleanup(qubes.storage._thin_pool_for_realpath.cache_clear)
+
+    def test_000_realpath_cache_key(self):
+        with unittest.mock.patch('qubes.storage._dm_table',
+                return_value=[(0, 2097152, 'linear', '8:1 0')]) \
+                as mock_dmsetup, \
+                unittest.mock.patch('os.path.isdir', return_value=True):
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp'),
+                (None, None))
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp/../tmp/'),
+                (None, None))
+        self.assertEqual(mock_dmsetup.call_count, 1)
+
+    def test_001_search_lvm_thin_pool_once(self):
+        pools = [unittest.mock.Mock(spec=['volume_group', 'thin_pool'],
+                volume_group='vg', thin_pool='pool{}'.format(i))
+            for i in range(3)]
+        with unittest.mock.patch.object(qubes.storage.DirectoryThinPool,
+                'thin_pool_real_path', return_value=('vg', 'pool2')) \
+                as mock_thin_pool:
+            self.assertIs(
+                qubes.storage.search_pool_containing_dir(pools, '/tmp'),
+                pools[2])
+        mock_thin_pool.assert_called_once_with(os.path.realpath('/tmp'))
+
+    def test_002_thin_pool(self):
+        with unittest.mock.patch('qubes.storage._dm_table',
+                return_value=[(0, 2097152, 'thin', '253:3 5')]), \
+                unittest.mock.patch('os.path.isdir', return_value=True), \
+                unittest.mock.patch('builtins.open', unittest.mock.mock_open(
+                    read_data='qubes_dom0-vm--pool-tpool\n')) as mock_open:
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp'),
+                ('qubes_dom0', 'vm-pool'))
+        mock_open.assert_called_once_with('/sys/dev/block/253:3/dm/name', 'r')
+
+    def test_003_dm_table_dmsetup(self):
+        with unittest.mock.patch('qubes.storage._libdevmapper',
+                return_value=None), \
+                unittest.mock.patch('subprocess.check_output',
+                    return_value=b'0 2097152 thin 253:3 5\n') as mock_dmsetup:
+            self.assertEqual(qubes.storage._dm_table(253, 4),
+                [(0, 2097152, 'thin', '253:3 5')])
+        # possibly prefixed with sudo
+        self.assertEqual(mock_dmsetup.call_args[0][0][-6:],
+            ['dmsetup', '-j', '253', '-m', '4', 'table'])
+
+    def test_004_not_dm_device(self):
+        with unittest.mock.patch('qubes.storage._dm_table') as mock_dmsetup, \
+                unittest.mock.patch('os.path.isdir', return_value=False):
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp'),
+                (None, None))
+        mock_dmsetup.assert_not_called()
+
+    def test_005_lookup_failure_not_cached(self):
+        with unittest.mock.patch('qubes.storage._dm_table',
+                side_effect=OSError) as mock_dmsetup, \
+                unittest.mock.patch('os.path.isdir', return_value=True):
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp'),
+                (None, None))
+            self.assertEqual(
+                qubes.storage.DirectoryThinPool.thin_pool('/tmp'),
+                (None, None))
+        self.assertEqual(mock_dmsetup.call_count, 2)
+
+    def test_006_search_pool_real_dir_path_cached(self):
+        pool = unittest.mock.Mock(spec=['dir_path'], dir_path='/tmp/../tmp')
+        with unittest.mock.patch('os.path.realpath',
+                wraps=os.path.realpath) as mock_realpath:
+            for _ in range(3):
+                self.assertIs(qubes.storage.search_pool_containing_dir(
+                    [pool], '/tmp'), pool)
+            self.assertEqual(mock_realpath.call_count, 4)
+            pool.dir_path = '/var'
+            self.assertIsNone(qubes.storage.search_pool_containing_dir(
+                [pool], '/tmp'))
+
+    def test_007_search_pool_containing_dir(self):
+        pools = [unittest.mock.Mock(spec=['dir_path'], dir_path=dir_path)
+            for dir_path in ('/var/lib/qubes-foo', '/var/lib/qubes')]
+        search = qubes.storage.search_pool_containing_dir
+        self.assertIs(search(pools, '/var/lib/qubes'), pools[1])
+        self.assertIs(search(pools, '/var/lib/qubes/appvms/a'), pools[1])
+        self.assertIs(search(pools, '/var/lib/qubes-foo/'), pools[0])
+        self.assertIsNone(search(pools, '/var/lib/qubes-bar'))
+        self.assertIsNone(search(pools, '/var/lib'))
+        root_pool = unittest.mock.Mock(spec=['dir_path'], dir_path='/')
+        self.assertIs(search([root_pool], '/var/lib'), root_pool)
+
+    def test_008_split_lvm_dm_name(self):
+        split = qubes.storage._split_lvm_dm_name
+        self.assertEqual(split('qubes_dom0-pool00-tpool'),
+            ['qubes_dom0', 'pool00', 'tpool'])
+        self.assertEqual(split('qubes--dom0-vm--pool-tpool'),
+            ['qubes-dom0', 'vm-pool', 'tpool'])
+        self.assertEqual(split('vg=1-a----b-tpool'),
+            ['vg=1', 'a--b', 'tpool'])
+        self.assertEqual(split('vg-lv'), ['vg', 'lv'])
+
+    def test_009_search_pool_realpath_once(self):
+        pool = unittest.mock.Mock(spec=['volume_group', 'thin_pool'],
+            volume_group='vg', thin_pool='pool')
+        with unittest.mock.patch('os.path.realpath',
+                wraps=os.path.realpath) as mock_realpath, \
+                unittest.mock.patch('qubes.storage._thin_pool_for_realpath',
+                    return_value=('vg', 'pool')):
+            self.assertIs(qubes.storage.search_pool_containing_dir(
+                [pool], '/tmp'), pool)
+        mock_realpath.assert_called_once_with('/tmp')
+
+    def test_010_search_pool_exact_dir_path(self):
+        pools = [unittest.mock.Mock(spec=['dir_path'], dir_path=dir_path)
+            for dir_path in ('/var/lib/qubes-foo', '/var/lib/qubes')]
+        with unittest.mock.patch('os.path.realpath',
+                wraps=os.path.realpath) as mock_realpath:
+            self.assertIs(qubes.storage.search_pool_containing_dir(
+                pools, '/var/lib/qubes-foo'), pools[0])
+            mock_realpath.assert_not_called()
+        # earlier pools are still checked first
+        nested = unittest.mock.Mock(spec=['dir_path'],
+            dir_path='/var/lib/qubes/nested')
+        self.assertIs(qubes.storage.search_pool_containing_dir(
+            [pools[1], nested], '/var/lib/qubes/nested'), pools[1])
+
+    def test_011_dm_table_libdevmapper(self):
+        table = [(0, 1024, 'linear', '8:1 2048'),
+            (1024, 2048, 'thin', '253:3 5')]
+        lib = FakeLibdevmapper(table)
+        with unittest.mock.patch('qubes.storage._libdevmapper',
+                return_value=lib), \
+                unittest.mock.patch('os.getuid', return_value=0), \
+                unittest.mock.patch('subprocess.check_output') as mock_dmsetup:
+            self.assertEqual(qubes.storage._dm_table(253, 4), table)
+        mock_dmsetup.assert_not_called()
+        lib.dm_task_set_major.assert_called_once_with(lib.task, 253)
+        lib.dm_task_set_minor.assert_called_once_with(lib.task, 4)
+        lib.dm_task_destroy.assert_called_once_with(lib.task)
+
+    def test_012_dm_table_libdevmapper_empty(self):
+        lib = FakeLibdevmapper([])
+        with unittest.mock.patch('qubes.storage._libdevmapper',
+                return_value=lib), \
+                unittest.mock.patch('os.getuid', return_value=0):
+            self.assertEqual(qubes.storage._dm_table(253, 4), [])
+        lib.dm_task_destroy.assert_called_once_with(lib.task)
+
+    def test_013_dm_table_libdevmapper_run_failed(self):
+        lib = FakeLibdevmapper([(0, 1024, 'linear', '8:1 2048')])
+        lib.dm_task_run.return_value = 0
+        with unittest.mock.patch('qubes.storage._libdevmapper',
+                return_value=lib), \
+                unittest.mock.patch('os.getuid', return_value=0):
+            with self.assertRaises(OSError):
+                qubes.storage._dm_table(253, 4)
+        lib.dm_get_next_target.assert_not_called()
+        lib.dm_task_destroy.assert_called_once_with(lib.task)
+
+    def test_014_libdevmapper_soname(self):
+        qubes.storage._libdevmapper.cache_clear()
+        self.addCleanup(qubes.storage._libdevmapper.cache_clear)
+        with unittest.mock.patch('ctypes.CDLL') as mock_cdll, \
+                unittest.mock.patch('ctypes.util.find_library') \
+                as mock_find_library:
+            self.assertIs(qubes.storage._libdevmapper(),
+                mock_cdll.return_value)
+        mock_cdll.assert_called_once_with('libdevmapper.so.1.02',
+            use_errno=True)
+        mock_find_library.assert_not_called()
+
+    def test_015_libdevmapper_find_library(self):
+        qubes.storage._libdevmapper.cache_clear()
+        self.addCleanup(qubes.storage._libdevmapper.cache_clear)
+        lib = unittest.mock.Mock()
+        with unittest.mock.patch('ctypes.CDLL',
+                side_effect=[OSError, lib]) as mock_cdll, \
+                unittest.mock.patch('ctypes.util.find_library',
+                    return_value='libdevmapper.so.1.02.1'):
+            self.assertIs(qubes.storage._libdevmapper(), lib)
+        mock_cdll.assert_called_with('libdevmapper.so.1.02.1',
+            use_errno=True)
+
+    def test_016_dm_table_not_root(self):
+        with unittest.mock.patch('qubes.storage._libdevmapper') as mock_lib, \
+                unittest.mock.patch('os.getuid', return_value=1000), \
+                unittest.mock.patch('subprocess.check_output',
+                    return_value=b'0 2097152 linear 8:1 0\n') as mock_dmsetup:
+            self.assertEqual(qubes.storage._dm_table(253, 4),
+                [(0, 2097152, 'linear', '8:1 0')])
+        mock_lib.assert_not_called()
+        self.assertEqual(mock_dmsetup.call_args[0][0][0], 'sudo')
+
+
+class FakeLibdevmapper:
+    """ Stand-in for the libdevmapper ctypes binding, serving the table
+    of a single device """
+    # pylint: disable=too-few-public-methods
+    task = 0x1000
+
+    def __init__(self, table):
+        self.table = table
+        self.dm_task_create = unittest.mock.Mock(return_value=self.task)
+        self.dm_task_set_major = unittest.mock.Mock(return_value=1)
+        self.dm_task_set_minor = unittest.mock.Mock(return_value=1)
+        self.dm_task_run = unittest.mock.Mock(return_value=1)
+        self.dm_task_destroy = unittest.mock.Mock()
+        self.dm_get_next_target = unittest.mock.Mock(
+            side_effect=self._get_next_target)
+
+    def _get_next_target(self, task, next_target,
+            start, length, target_type, target_args):
+        # pylint: disable=too-many-arguments
+        assert task == self.task
+        # "pointers" to targets are their 1-based index
+        index = next_target or 0
+        if index < len(self.table):
+            start._obj.value, length._obj.value, ttype, targs = \
+                self.table[index]
+            target_type._obj.value = ttype.encode()
+            target_args._obj.value = targs.encode()
+        # NULL after the last target (and for an empty table)
+        if index + 1 < len(self.table):
+            return index + 1
+        return None
+
+
+class TC_05_DriverEntryPoints(QubesTestCase):
+    """ This class tests pool driver discovery in :py:mod:`qubes.storage`,
+    with fake entry points """
+
+    def setUp(self):
+        super().setUp()
+        self.entry_points = []
+        patch = unittest.mock.patch('qubes.storage._storage_entry_points',
+            side_effect=lambda: iter(self.entry_points))
+        self.mock_entry_points = patch.start()
+        self.addCleanup(patch.stop)
+        self.clear_cache()
+        self.addCleanup(self.clear_cache)
+
+    @staticmethod
+    def clear_cache():
+        qubes.storage._all_driver_entry_points.cache_clear()
+        qubes.storage._driver_entry_points.cache_clear()
+        qubes.storage.driver_parameters.cache_clear()
+        qubes.storage._driver_classes.clear()
+
+    def add_entry_point(self, name, value):
+        entry_point = unittest.mock.Mock(spec=['name', 'value', 'load'],
+            value=value)
+        entry_point.name = name
+        self.entry_points.append(entry_point)
+        return entry_point
+
+    def test_000_no_drivers_scanned_once(self):
+        self.assertEqual(pool_drivers(), [])
+        self.assertEqual(pool_drivers(), [])
+        self.assertEqual(self.mock_entry_points.call_count, 1)
+
+    def test_001_same_entry_point_twice(self):
+        file_ep = self.add_entry_point('file', 'qubes.storage.file:FilePool')
+        self.add_entry_point('file', 'qubes.storage.file:FilePool')
+        self.assertEqual(pool_drivers(), ['file'])
+        self.assertIs(qubes.storage._get_driver('file'), file_ep)
+
+    def test_002_duplicate_driver(self):
+        self.add_entry_point('file', 'qubes.storage.file:FilePool')
+        self.add_entry_point('file', 'other.storage:FilePool')
+        self.add_entry_point('lvm_thin', 'qubes.storage.lvm:ThinPool')
+        self.assertEqual(pool_drivers(), ['lvm_thin'])
+        with self.assertRaises(TypeError):
+            qubes.storage._get_driver('file')
+        with self.assertRaises(KeyError):
+            qubes.storage._get_driver('missing')
+
+    def test_003_driver_parameters(self):
+        class Driver(qubes.storage.Pool):
+            # pylint: disable=super-init-not-called,unused-argument
+            def __init__(self, a, *args, name, b, **kw):
+                pass
+        entry_point = self.add_entry_point('test', 'test:Driver')
+        entry_point.load.return_value = Driver
+        params = qubes.storage.driver_parameters('test')
+        self.assertEqual(params, ('a', 'b'))
+        self.assertIsInstance(params, tuple)
+        self.assertIs(qubes.storage.driver_parameters('test'), params)
+        entry_point.load.assert_called_once_with()
+
+    def test_004_driver_parameters_decorated(self):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            return wrapper
+        class Driver(qubes.storage.Pool):
+            # pylint: disable=super-init-not-called,unused-argument
+            @decorator
+            def __init__(self, *, name, dir_path, revisions_to_keep=1):
+                pass
+        self.add_entry_point('test', 'test:Driver').load.return_value = Driver
+        self.assertEqual(qubes.storage.driver_parameters('test'),
+            ('dir_path', 'revisions_to_keep'))
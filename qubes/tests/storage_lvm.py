@@ -1127,7 +1127,7 @@ class TC_02_StorageHelpers(ThinPoolBase):
         os.environ['QUBES_XML_PATH'] = xml_path
         super().setUp(**kwargs)
         # reset cache
-        qubes.storage.DirectoryThinPool._thin_pool = {}
+        qubes.storage._thin_pool_for_realpath.cache_clear()
 
         self.thin_dir = tempfile.TemporaryDirectory()
         subprocess.check_call(
@@ -32,8 +32,6 @@ import subprocess
 import tempfile
 from contextlib import contextmanager, suppress
 
-import pkg_resources
-
 import docutils
 import docutils.core
 import docutils.io
@@ -143,6 +141,9 @@ def urandom(size):
 
 
 def get_entry_point_one(group, name):
+    # imported here, as importing pkg_resources is expensive (it scans all
+    # installed distributions)
+    import pkg_resources
     epoints = tuple(pkg_resources.iter_entry_points(group, name))
     if not epoints:
         raise KeyError(name)
@@ -240,9 +241,24 @@ async def void_coros_maybe(values):
         objects. Run all coroutine objects to completion, concurrent
         with each other. If there were exceptions, raise the leftmost
         one (not necessarily chronologically first). Return nothing.
+
+        The iterable is consumed completely before any coroutine is
+        scheduled, so if producing it raises (synchronous operations do),
+        none of them runs. Then all of them are scheduled on the event
+        loop before any is waited for, so passing a generator does not
+        serialize them.
     '''
-    coros = [val for val in values if asyncio.iscoroutine(val)]
-    if coros:
-        done, _ = await asyncio.wait(coros)
-        for task in done:
+    coros = []
+    try:
+        for val in values:
+            if asyncio.iscoroutine(val):
+                coros.append(val)
+    except:
+        for coro in coros:
+            coro.close()
+        raise
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    if tasks:
+        await asyncio.wait(tasks)
+        for task in tasks:
             task.result()  # re-raises exception if task failed